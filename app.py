@@ -1,106 +1,401 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
+import shutil
 import yt_dlp
-import re
 import threading
 import time
 import subprocess
 import logging
-import random
-import json
+import uuid
+import mimetypes
+import multiprocessing
+import tempfile
+from collections import namedtuple, deque
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+try:
+    import orjson
+except ImportError:  # optional; falls back to Flask's stdlib encoder
+    orjson = None
+from tasks import (
+    DOWNLOAD_FOLDER, MAX_DURATION_SECONDS, FFMPEG_PATH, LAME_COMPRESSION_LEVEL,
+    get_ydl_opts, get_output_name, extract_info_cached, run_conversion_batch
+)
+
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
 CORS(app)
+# Heroku's router (one hop) sits in front of the app; trust its X-Forwarded-*
+# headers so remote_addr is the client, not the router, for per-IP rate limits
+# and the scheme in generated URLs is right. Set PROXY_HOPS=0 when exposed directly.
+PROXY_HOPS = int(os.getenv("PROXY_HOPS", 1))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+# Let a front-end proxy (Apache mod_xsendfile, lighttpd) serve downloads from disk
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "").lower() in ("1", "true", "yes")
+# Behind nginx, hand the file back to the proxy via X-Accel-Redirect so it is
+# sent with sendfile(2) and never passes through Python, e.g. with
+# ACCEL_REDIRECT_PREFIX=/_protected/ and:
+#     location /_protected/ { internal; alias /app/downloads/; sendfile on; }
+ACCEL_REDIRECT_PREFIX = os.getenv("ACCEL_REDIRECT_PREFIX")
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Constants
-DOWNLOAD_FOLDER = "downloads"
-os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
-MAX_DURATION_SECONDS = 150 * 60
-MAX_FILENAME_LENGTH = 128
+STREAM_CHUNK_SIZE = 64 * 1024
+FILE_TTL_SECONDS = 600
+# New conversions are refused below this much free space in DOWNLOAD_FOLDER,
+# which matters most when it is a size-capped tmpfs
+MIN_FREE_BYTES = 200 * 1024 * 1024
+YOUTUBE_HOSTS = frozenset({"youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com", "youtu.be"})
+VALID_FORMATS = frozenset({"mp3", "mp4"})
+STREAM_FORMATS = frozenset({"mp3"})
+MAX_BATCH_URLS = 10
+
+# Bodies for the errors that junk traffic hits most, encoded once at import
+_ERR_JSON_EXPECTED = b'{"error":"JSON expected"}'
+_ERR_INVALID_URL = b'{"error":"Invalid YouTube URL"}'
+_ERR_INVALID_FORMAT = b'{"error":"Invalid format"}'
+_ERR_STORAGE_FULL = b'{"error":"Server storage full, try again later"}'
+_ERR_UNKNOWN_JOB = b'{"error":"Unknown or expired job"}'
+_ERR_INVALID_FILENAME = b'{"error":"Invalid filename"}'
+_ERR_FILE_NOT_FOUND = b'{"error":"File expired or not found"}'
+_ERR_URLS_EXPECTED = b'{"error":"urls must be a non-empty list"}'
+_ERR_TOO_MANY_URLS = f'{{"error":"At most {MAX_BATCH_URLS} URLs per batch"}}'.encode()
+_ERR_NOT_SINGLE_VIDEO = b'{"error":"Only single videos are supported"}'
+_ERR_TOO_LONG = b'{"error":"Video too long"}'
+_ERR_NOT_STREAMABLE = b'{"error":"No streamable audio format"}'
+_ERR_STREAM_FAILED = b'{"error":"Could not fetch the audio stream"}'
+
+# Finished conversions keyed by (url, format), so repeat requests skip yt-dlp and ffmpeg
+CachedConversion = namedtuple("CachedConversion", ["path", "expiry", "payload"])
+CACHE = {}
+CACHE_LOCK = threading.Lock()
+# Conversions still running, (url, format) -> job_id, so a repeat request (another
+# user, a client retry) joins the existing job instead of racing it on the same
+# files. Also guarded by CACHE_LOCK.
+IN_FLIGHT = {}
+
+# Conversions run in worker processes; JOBS maps job_id -> Future until the
+# finished job ages out of _FINISHED_JOBS. Job state lives in this process only,
+# so the Procfile pins gunicorn to one worker: with more, /status polls landing
+# on another worker would 404 and each would start its own conversion pool.
+MAX_WORKERS = int(os.getenv("CONVERT_WORKERS", 0)) or os.cpu_count() or 1
+# Workers come from a forkserver rather than a plain fork() of this process,
+# which would copy locks held by request, sweeper and dispatcher threads (TLS,
+# logging, _PENDING_CV) into the child. The server preloads tasks (and yt-dlp),
+# so starting a worker stays cheap.
+_MP_CONTEXT = multiprocessing.get_context("forkserver")
+_MP_CONTEXT.set_forkserver_preload(["tasks"])
+EXECUTOR = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=_MP_CONTEXT)
+JOBS = {}
+_FINISHED_JOBS = deque()
+# Request threads prune concurrently; without it two can race for the last entry
+_PRUNE_LOCK = threading.Lock()
+
+# Requests arriving within BATCH_WINDOW_SECONDS are coalesced into batches and
+# spread over the pool
+BATCH_WINDOW_SECONDS = 0.2
+BATCH_MAX_SIZE = 8
+_PENDING = []
+_PENDING_CV = threading.Condition()
+
+# Expired files are found by mtime: one sweeper thread scans DOWNLOAD_FOLDER every
+# SWEEP_INTERVAL_SECONDS, which also catches files orphaned by a crash or restart
+SWEEP_INTERVAL_SECONDS = 60
+
+# /stream extracts on the request thread; each thread keeps one YoutubeDL so the
+# extractor registry is built once per thread rather than once per request
+_STREAM_YDL = threading.local()
 
 # Rate limiter
 def get_user_id():
-    return str(request.get_json().get("user_id", "anonymous")) if request.is_json else "anonymous"
+    if request.method != "POST":
+        return get_remote_address()
+    # Parsed body is cached on the request, so the view reuses it
+    data = request.get_json(silent=True)
+    return str(data.get("user_id", "anonymous")) if isinstance(data, dict) else "anonymous"
+
+def get_batch_cost():
+    # Each URL in a batch is a conversion, so it costs what a /convert call does
+    data = request.get_json(silent=True)
+    urls = data.get("urls") if isinstance(data, dict) else None
+    return min(len(urls), MAX_BATCH_URLS) if isinstance(urls, list) and urls else 1
 
 limiter = Limiter(
     key_func=get_user_id,
     app=app,
     default_limits=["30 per hour"],
-    storage_uri="memory://"
+    # Shared Redis counters keep limits exact across gunicorn workers and restarts
+    storage_uri=os.getenv("REDIS_URL", "memory://"),
+    # Rolling window instead of fixed buckets: no 2x burst at a window boundary.
+    # On Redis each hit is a single atomic Lua call.
+    strategy="moving-window"
 )
 
-USER_AGENTS = [
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0",
-    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1",
-    "Mozilla/5.0 (Linux; Android 13; SM-G991B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Mobile Safari/537.36"
-]
+def check_ffmpeg():
+    if FFMPEG_PATH is None:
+        logger.error("FFmpeg check failed: not found in PATH")
+        raise EnvironmentError("FFmpeg is not installed or not in system PATH.")
+    logger.info("FFmpeg check passed: %s", FFMPEG_PATH)
+
+def error_response(body, status):
+    return Response(body, status=status, mimetype="application/json")
 
-PROXIES = os.getenv('PROXIES', '').split(',') if os.getenv('PROXIES') else None
+def is_youtube_url(url):
+    if not isinstance(url, str):
+        return False
+    try:
+        parts = urlsplit(url)
+        # .hostname is lowercased and has any port or userinfo stripped
+        return parts.scheme in ("http", "https") and parts.hostname in YOUTUBE_HOSTS
+    except ValueError:  # e.g. a malformed IPv6 host or port
+        return False
 
-def check_ffmpeg():
+def validate_request(valid_formats=VALID_FORMATS):
+    """Returns ((url, format), None) for a valid body, else (None, error response)."""
+    data = request.get_json(silent=True) if request.is_json else None
+    if not isinstance(data, dict):
+        return None, error_response(_ERR_JSON_EXPECTED, 400)
+    url = data.get("url")
+    if not is_youtube_url(url):
+        return None, error_response(_ERR_INVALID_URL, 400)
+    file_format = str(data.get("format", "mp3")).lower()
+    if file_format not in valid_formats:
+        return None, error_response(_ERR_INVALID_FORMAT, 400)
+    return (url, file_format), None
+
+def validate_batch_request():
+    """Returns ((urls, format), None) for a valid body, else (None, error response)."""
+    data = request.get_json(silent=True) if request.is_json else None
+    if not isinstance(data, dict):
+        return None, error_response(_ERR_JSON_EXPECTED, 400)
+    urls = data.get("urls")
+    if not isinstance(urls, list) or not urls:
+        return None, error_response(_ERR_URLS_EXPECTED, 400)
+    if len(urls) > MAX_BATCH_URLS:
+        return None, error_response(_ERR_TOO_MANY_URLS, 400)
+    invalid = [url for url in urls if not is_youtube_url(url)]
+    if invalid:
+        return None, (jsonify({"error": "Invalid YouTube URL", "urls": invalid}), 400)
+    file_format = str(data.get("format", "mp3")).lower()
+    if file_format not in VALID_FORMATS:
+        return None, error_response(_ERR_INVALID_FORMAT, 400)
+    # Duplicates would only queue the same conversion twice
+    return (list(dict.fromkeys(urls)), file_format), None
+
+def has_free_space():
+    return shutil.disk_usage(DOWNLOAD_FOLDER).free >= MIN_FREE_BYTES
+
+def sweep_downloads():
+    cutoff = time.time() - FILE_TTL_SECONDS
+    with os.scandir(DOWNLOAD_FOLDER) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    logger.info("Deleted file: %s", entry.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error("Failed to delete %s: %s", entry.path, e)
+
+    now = time.time()
+    with CACHE_LOCK:
+        for cache_key in [key for key, entry in CACHE.items() if entry.expiry <= now]:
+            del CACHE[cache_key]
+
+def _sweeper():
+    while True:
+        time.sleep(SWEEP_INTERVAL_SECONDS)
+        try:
+            sweep_downloads()
+        except OSError as e:
+            logger.error("Sweeping %s failed: %s", DOWNLOAD_FOLDER, e)
+
+threading.Thread(target=_sweeper, daemon=True).start()
+
+def cache_conversion(cache_key, filepath, payload):
+    with CACHE_LOCK:
+        CACHE[cache_key] = CachedConversion(filepath, time.time() + FILE_TTL_SECONDS, payload)
+
+def get_cached_conversion(cache_key):
+    with CACHE_LOCK:
+        entry = CACHE.get(cache_key)
+        if not entry:
+            return None
+        if entry.expiry <= time.time():
+            del CACHE[cache_key]
+            return None
+        try:
+            # Bump the mtime so the sweeper keeps the file for the fresh download link
+            os.utime(entry.path)
+        except OSError:
+            del CACHE[cache_key]
+            return None
+        CACHE[cache_key] = entry._replace(expiry=time.time() + FILE_TTL_SECONDS)
+        return entry.payload
+
+def get_stream_ydl():
+    ydl = getattr(_STREAM_YDL, "ydl", None)
+    if ydl is None:
+        ydl = _STREAM_YDL.ydl = yt_dlp.YoutubeDL(get_ydl_opts("mp3"))
+    return ydl
+
+def drop_stream_ydl():
+    # Next request on this thread starts over with a fresh user agent and proxy
+    ydl = getattr(_STREAM_YDL, "ydl", None)
+    if ydl is not None:
+        _STREAM_YDL.ydl = None
+        ydl.close()
+
+def get_stream_command(info, proxy=None):
+    # ffmpeg pulls the selected audio stream itself and writes MP3 frames to stdout
+    headers = "".join(f"{k}: {v}\r\n" for k, v in info.get("http_headers", {}).items())
+    cmd = [FFMPEG_PATH, "-loglevel", "error", "-nostdin"]
+    if headers:
+        cmd += ["-headers", headers]
+    if proxy:
+        cmd += ["-http_proxy", proxy]
+    cmd += ["-i", info["url"], "-vn", "-acodec", "libmp3lame", "-q:a", "4", "-compression_level", LAME_COMPRESSION_LEVEL,
+            "-threads", "0", "-f", "mp3", "pipe:1"]
+    return cmd
+
+def submit_conversion(url, file_format):
+    future = Future()
+    with _PENDING_CV:
+        _PENDING.append((url, file_format, future))
+        _PENDING_CV.notify()
+    return future
+
+def resolve_batch(futures, batch_future):
     try:
-        subprocess.run(["ffmpeg", "-version"], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        logger.info("FFmpeg check passed")
+        results = batch_future.result()
     except Exception as e:
-        logger.error(f"FFmpeg check failed: {str(e)}")
-        raise EnvironmentError("FFmpeg is not installed or not in system PATH.")
+        for future in futures:
+            future.set_exception(e)
+        return
+    for future, result in zip(futures, results):
+        future.set_result(result)
+
+def submit_batch(jobs):
+    global EXECUTOR
+    try:
+        return EXECUTOR.submit(run_conversion_batch, jobs)
+    except BrokenProcessPool:
+        # A worker died abruptly (OOM kill, segfault); the old pool refuses all
+        # further work, so start a new one
+        logger.error("Conversion pool is broken, starting a new one")
+        EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        EXECUTOR = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=_MP_CONTEXT)
+        return EXECUTOR.submit(run_conversion_batch, jobs)
+
+def _batch_dispatcher():
+    while True:
+        with _PENDING_CV:
+            while not _PENDING:
+                _PENDING_CV.wait()
+            deadline = time.time() + BATCH_WINDOW_SECONDS
+            while len(_PENDING) < BATCH_MAX_SIZE * MAX_WORKERS:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                _PENDING_CV.wait(timeout=remaining)
+            pending = _PENDING[:BATCH_MAX_SIZE * MAX_WORKERS]
+            del _PENDING[:len(pending)]
+
+        # Spread the burst over the pool so batching never costs parallelism
+        for i in range(min(len(pending), MAX_WORKERS)):
+            batch = pending[i::MAX_WORKERS]
+            futures = [future for _, _, future in batch]
+            for future in futures:
+                future.set_running_or_notify_cancel()
+            try:
+                batch_future = submit_batch([(url, fmt) for url, fmt, _ in batch])
+            except Exception as e:
+                # Fail these jobs rather than the dispatcher, which would leave
+                # them (and every later job) stuck in "processing"
+                logger.error("Submitting a conversion batch failed: %s", e)
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            batch_future.add_done_callback(lambda f, futures=futures: resolve_batch(futures, f))
+
+threading.Thread(target=_batch_dispatcher, daemon=True).start()
 
-def get_random_user_agent():
-    return random.choice(USER_AGENTS)
-
-def get_random_proxy():
-    return random.choice(PROXIES) if PROXIES else None
-
-def sanitize_filename(title):
-    return re.sub(r'[\\/*?:"<>|]', '_', title)[:MAX_FILENAME_LENGTH]
-
-def delete_file_later(filepath, delay=600):
-    def delete():
-        time.sleep(delay)
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            logger.info(f"Deleted file: {filepath}")
-    threading.Thread(target=delete, daemon=True).start()
-
-def get_ydl_opts(file_format, output_path, retry_count=0):
-    opts = {
-        'format': 'bestaudio/best' if file_format == "mp3" else 'bestvideo[height<=1080]+bestaudio/best',
-        'outtmpl': output_path,
-        'quiet': True,
-        'retries': 3,
-        'socket_timeout': 30 + retry_count * 10,
-        'user_agent': get_random_user_agent(),
-        'referer': 'https://www.youtube.com/',
-        'proxy': get_random_proxy(),
-        'throttled_rate': '500K',
-        'extractor_args': {'youtube': {'skip': ['hls', 'dash'], 'player_client': ['android', 'web']}},
-        'compat_opts': {'youtube-skip-dash-manifest': True, 'no-youtube-unavailable-videos': True}
+def finish_job(job_id, cache_key, future):
+    _FINISHED_JOBS.append((time.time(), job_id))
+    if not future.cancelled() and not future.exception():
+        result, status_code = future.result()
+        if status_code == 200:
+            cache_conversion(cache_key, os.path.join(DOWNLOAD_FOLDER, result["filename"]), result)
+    # Only after caching, so a repeat request always finds one or the other
+    with CACHE_LOCK:
+        IN_FLIGHT.pop(cache_key, None)
+
+def prune_jobs():
+    cutoff = time.time() - FILE_TTL_SECONDS
+    with _PRUNE_LOCK:
+        while _FINISHED_JOBS and _FINISHED_JOBS[0][0] < cutoff:
+            _, job_id = _FINISHED_JOBS.popleft()
+            JOBS.pop(job_id, None)
+
+def conversion_response(result):
+    return {
+        "status": "finished",
+        "title": result["title"],
+        "duration": result["duration"],
+        "download_url": request.url_root.rstrip('/') + '/download/' + result["filename"]
+    }
+
+def start_conversion(url, file_format):
+    """Returns the finished conversion if cached, else the id of its (possibly new) job.
+    Returns None when a new job is needed but DOWNLOAD_FOLDER is short on space."""
+    cache_key = (url, file_format)
+    cached = get_cached_conversion(cache_key)
+    if cached:
+        return conversion_response(cached)
+
+    future = None
+    with CACHE_LOCK:
+        job_id = IN_FLIGHT.get(cache_key)
+        if job_id is None:
+            # Only new jobs need disk; cache hits and joined jobs are still served
+            if not has_free_space():
+                return None
+            job_id = IN_FLIGHT[cache_key] = uuid.uuid4().hex
+            future = JOBS[job_id] = submit_conversion(url, file_format)
+    if future is not None:
+        # Outside the lock: an already-finished future runs finish_job right here
+        future.add_done_callback(lambda f: finish_job(job_id, cache_key, f))
+    return {
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": request.url_root.rstrip('/') + '/status/' + job_id
     }
-    if file_format == "mp3":
-        opts['postprocessors'] = [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }]
-    elif file_format == "mp4":
-        opts['merge_output_format'] = 'mp4'
-    return opts
 
 # Initialization check
 try:
     check_ffmpeg()
 except Exception as e:
-    logger.critical(f"Startup failed: {str(e)}")
+    logger.critical("Startup failed: %s", e)
     raise
 
 @app.route('/')
@@ -114,79 +409,153 @@ def health():
 @app.route("/convert", methods=["POST"])
 @limiter.limit("3 per minute")
 def convert():
-    if not request.is_json:
-        return jsonify({"error": "JSON expected"}), 400
+    params, error = validate_request()
+    if error:
+        return error
+    url, file_format = params
 
-    data = request.get_json()
-    url = data.get("url")
-    file_format = data.get("format", "mp3").lower()
+    prune_jobs()
+    result = start_conversion(url, file_format)
+    if result is None:
+        return error_response(_ERR_STORAGE_FULL, 507)
+    return jsonify(result), 202 if "job_id" in result else 200
 
-    if not url or not re.match(r'^https?://(www\.)?(youtube\.com|youtu\.be)/', url):
-        return jsonify({"error": "Invalid YouTube URL"}), 400
-    if file_format not in ["mp3", "mp4"]:
-        return jsonify({"error": "Invalid format"}), 400
+@app.route("/convert_batch", methods=["POST"])
+# Same average rate as /convert, over a window wide enough for a full batch
+@limiter.limit("30 per 10 minutes", cost=get_batch_cost)
+def convert_batch():
+    params, error = validate_batch_request()
+    if error:
+        return error
+    urls, file_format = params
 
-    for attempt in range(3):
-        try:
-            with yt_dlp.YoutubeDL({
-                'quiet': True,
-                'extract_flat': True,
-                'user_agent': get_random_user_agent(),
-                'proxy': get_random_proxy(),
-                'socket_timeout': 30
-            }) as ydl:
-                info = ydl.extract_info(url, download=False)
-                duration = info.get("duration", 0)
-                if duration > MAX_DURATION_SECONDS:
-                    return jsonify({"error": "Video too long"}), 400
-
-                title = sanitize_filename(info.get("title", "media"))
-                output_filename = f"{title}.{file_format}"
-                output_path = os.path.join(DOWNLOAD_FOLDER, output_filename)
-
-            time.sleep(random.uniform(1, 3))
-            ydl_opts = get_ydl_opts(file_format, output_path, attempt)
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-
-            delete_file_later(output_path)
-            download_url = request.url_root.rstrip('/') + '/download/' + secure_filename(output_filename)
-
-            return jsonify({
-                "title": title,
-                "duration": duration,
-                "download_url": download_url
-            })
-
-        except yt_dlp.utils.DownloadError as e:
-            if "bot" in str(e).lower() or "429" in str(e):
-                if attempt < 2:
-                    time.sleep(5 * (attempt + 1))
-                    continue
-                return jsonify({"error": "YouTube temporary restriction", "code": "rate_limit"}), 429
-            return jsonify({"error": "Download failed", "details": str(e)}), 400
-
-        except Exception as e:
-            if attempt < 2:
-                time.sleep(5)
-                continue
-            return jsonify({"error": "Internal error", "details": str(e)}), 500
+    # Jobs submitted together land in the same dispatch window and are spread
+    # across the worker pool, so the batch converts in parallel
+    prune_jobs()
+    results = []
+    for url in urls:
+        result = start_conversion(url, file_format)
+        if result is None:
+            result = {"status": "failed", "error": "Server storage full, try again later"}
+        results.append({"url": url, **result})
+    statuses = {result["status"] for result in results}
+    if statuses == {"failed"}:
+        return jsonify({"results": results}), 507
+    return jsonify({"results": results}), 202 if "queued" in statuses else 200
+
+@app.route("/status/<job_id>")
+@limiter.limit("60 per minute")
+def status(job_id):
+    future = JOBS.get(job_id)
+    if future is None:
+        return error_response(_ERR_UNKNOWN_JOB, 404)
+    if not future.done():
+        return jsonify({"job_id": job_id, "status": "processing" if future.running() else "queued"})
+
+    try:
+        result, status_code = future.result()
+    except Exception as e:
+        return jsonify({"job_id": job_id, "status": "failed", "error": "Internal error", "details": str(e)}), 500
+    if status_code != 200:
+        return jsonify({"job_id": job_id, "status": "failed", **result}), status_code
+    return jsonify({"job_id": job_id, **conversion_response(result)})
 
 @app.route("/download/<filename>")
 def download(filename):
+    # Names are generated already sanitized, so anything else is not ours
+    if filename != secure_filename(filename):
+        return error_response(_ERR_INVALID_FILENAME, 400)
+    if ACCEL_REDIRECT_PREFIX:
+        if not os.path.isfile(os.path.join(DOWNLOAD_FOLDER, filename)):
+            return error_response(_ERR_FILE_NOT_FOUND, 404)
+        return Response(
+            mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+            headers={
+                "X-Accel-Redirect": ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + filename,
+                "Content-Disposition": f'attachment; filename="{filename}"'
+            }
+        )
     try:
-        safe_filename = secure_filename(filename)
-        return send_from_directory(
-            DOWNLOAD_FOLDER,
-            safe_filename,
+        return send_file(
+            os.path.join(DOWNLOAD_FOLDER, filename),
             as_attachment=True,
-            download_name=safe_filename
+            download_name=filename,
+            conditional=True,
+            etag=True
         )
     except FileNotFoundError:
-        return jsonify({"error": "File expired or not found"}), 404
+        return error_response(_ERR_FILE_NOT_FOUND, 404)
     except Exception as e:
         return jsonify({"error": "Download error", "details": str(e)}), 500
 
+@app.route("/stream", methods=["POST"])
+@limiter.limit("3 per minute")
+def stream():
+    params, error = validate_request(STREAM_FORMATS)
+    if error:
+        return error
+    url, _ = params
+
+    ydl = get_stream_ydl()
+    try:
+        # Always extract afresh: ffmpeg fetches the signed media URL itself, and a
+        # cached one may be bound to another worker's IP or proxy (403)
+        info, _ = extract_info_cached(ydl, url, read_cache=False)
+        if info.get("_type", "video") != "video":
+            return error_response(_ERR_NOT_SINGLE_VIDEO, 400)
+        if (info.get("duration") or 0) > MAX_DURATION_SECONDS:
+            return error_response(_ERR_TOO_LONG, 400)
+        info = ydl.process_ie_result(info, download=False)
+    except yt_dlp.utils.DownloadError as e:
+        drop_stream_ydl()
+        return jsonify({"error": "Download failed", "details": str(e)}), 400
+    if not info.get("url"):
+        return error_response(_ERR_NOT_STREAMABLE, 400)
+
+    # stderr goes to a file, not a pipe nobody drains while stdout is streaming
+    errlog = tempfile.TemporaryFile()
+    proc = subprocess.Popen(
+        get_stream_command(info, ydl.params.get('proxy')),
+        stdout=subprocess.PIPE,
+        stderr=errlog,
+        # Unbuffered: read() hands back whatever ffmpeg has produced instead of
+        # waiting for a full chunk, so the first frames go out immediately
+        bufsize=0
+    )
+
+    def finish(completed):
+        if not completed:  # client went away mid-stream
+            proc.kill()
+        if proc.wait() and completed:
+            errlog.seek(0)
+            logger.error("ffmpeg stream of %s failed (exit %s): %s", url, proc.returncode,
+                         errlog.read()[-2000:].decode(errors="replace").strip())
+        errlog.close()
+
+    # Wait for the first chunk so a failed fetch is still reported as an error,
+    # rather than as a 200 with an empty audio body
+    first_chunk = proc.stdout.read(STREAM_CHUNK_SIZE)
+    if not first_chunk:
+        finish(True)
+        return error_response(_ERR_STREAM_FAILED, 502)
+
+    def generate():
+        completed = False
+        try:
+            yield first_chunk
+            for chunk in iter(lambda: proc.stdout.read(STREAM_CHUNK_SIZE), b''):
+                yield chunk
+            completed = True
+        finally:
+            finish(completed)
+
+    filename = get_output_name(info) + ".mp3"
+    return Response(
+        stream_with_context(generate()),
+        mimetype="audio/mpeg",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,227 @@
+"""yt-dlp + ffmpeg conversion pipeline, run inside the app's worker processes."""
+import os
+import re
+import time
+import json
+import shutil
+import random
+import logging
+import itertools
+import redis
+import yt_dlp
+from yt_dlp.extractor.youtube import YoutubeIE
+from yt_dlp.networking.impersonate import ImpersonateTarget
+from werkzeug.utils import secure_filename
+try:
+    # Registers yt-dlp's curl_cffi request handler; raises ImportError when
+    # curl_cffi is missing or not the version this yt-dlp supports
+    import yt_dlp.networking._curlcffi
+    IMPERSONATE_TARGET = ImpersonateTarget.from_str("chrome")
+except ImportError:  # optional; falls back to plain requests with a rotated user agent
+    IMPERSONATE_TARGET = None
+
+logger = logging.getLogger(__name__)
+
+# Constants
+# Converted files are short-lived, so this is best pointed at a tmpfs mount
+# (e.g. /dev/shm/yt-mp3, docker --tmpfs, systemd RuntimeDirectory=)
+DOWNLOAD_FOLDER = os.getenv("DOWNLOAD_FOLDER", "downloads")
+os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+MAX_DURATION_SECONDS = 150 * 60
+MAX_FILENAME_LENGTH = 128
+# Prefer H.264/AAC streams so the mp4 merge is a stream copy rather than a re-encode
+MP4_FORMAT = (
+    'bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/'
+    'best[height<=1080][ext=mp4]/'
+    'bestvideo[height<=1080]+bestaudio/best'
+)
+# LAME's -q algorithm level: 0 is slowest/best, 9 fastest; 7 matches `lame -f`
+LAME_COMPRESSION_LEVEL = '7'
+_BAD_CHARS_RE = re.compile(r'[\\/*?:"<>|]')
+
+# Raw extractor results shared between workers through Redis, keyed by video id.
+# Short TTL: the format URLs inside are signed and eventually expire.
+REDIS_URL = os.getenv("REDIS_URL")
+INFO_CACHE_TTL_SECONDS = 300
+_REDIS = None
+
+# After YouTube pushes back (bot check / 429), this worker's next extractions are
+# spaced out with a little jitter instead of delaying every request
+RATE_LIMIT_COOLDOWN_SECONDS = 60
+_rate_limited_until = 0.0
+
+USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (Linux; Android 13; SM-G991B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Mobile Safari/537.36"
+)
+
+# Resolved once; also handed to yt-dlp so it skips its own lookup
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+PROXIES = tuple(p.strip() for p in os.getenv('PROXIES', '').split(',') if p.strip())
+
+# Rotate through USER_AGENTS; cycle.__next__ is a single C call, unlike random.choice
+get_user_agent = itertools.cycle(USER_AGENTS).__next__
+
+def get_random_proxy():
+    return random.choice(PROXIES) if PROXIES else None
+
+def sanitize_filename(title):
+    return _BAD_CHARS_RE.sub('_', title)[:MAX_FILENAME_LENGTH]
+
+def get_output_name(info):
+    # Used verbatim for the file on disk and the download URL, so sanitize exactly once.
+    # The id keeps different videos that share a title from writing the same file.
+    name = secure_filename(sanitize_filename(info.get("title", "media")))
+    return secure_filename(f"{name}-{info.get('id', 'media')}")
+
+def get_redis():
+    # Created lazily so each worker process opens its own connection pool
+    global _REDIS
+    if _REDIS is None and REDIS_URL:
+        _REDIS = redis.Redis.from_url(REDIS_URL)
+    return _REDIS
+
+def get_info_cache_key(url):
+    # Same URL parsing yt-dlp itself uses, so the key names the video it will extract
+    video_id = YoutubeIE.get_temp_id(url) if get_redis() is not None else None
+    return f"ytinfo:{video_id}" if video_id else None
+
+def extract_info_cached(ydl, url, read_cache=True):
+    """Returns (unprocessed info, from_cache)."""
+    key = get_info_cache_key(url)
+    if key and read_cache:
+        try:
+            cached = get_redis().get(key)
+            if cached:
+                info = json.loads(cached)
+                # The cache is shared by all users; never serve another video's entry
+                if key == f"ytinfo:{info.get('id')}":
+                    return info, True
+        except redis.RedisError as e:
+            logger.warning("Info cache read failed: %s", e)
+
+    if time.monotonic() < _rate_limited_until:
+        time.sleep(random.uniform(1, 3))
+    info = ydl.extract_info(url, download=False, process=False)
+    if info.get("_type") in ("url", "url_transparent"):
+        # With noplaylist, watch?v=ID&list=... resolves to a url result for the
+        # video itself; follow it so only real playlists fail the single-video check
+        info = ydl.extract_info(info["url"], download=False, process=False, ie_key=info.get("ie_key"))
+    if key and info.get("_type", "video") == "video" and key == f"ytinfo:{info.get('id')}":
+        try:
+            get_redis().setex(key, INFO_CACHE_TTL_SECONDS,
+                              json.dumps(ydl.sanitize_info(info, remove_private_keys=True)))
+        except redis.RedisError as e:
+            logger.warning("Info cache write failed: %s", e)
+    return info, False
+
+def forget_info(url):
+    key = get_info_cache_key(url)
+    if key:
+        try:
+            get_redis().delete(key)
+        except redis.RedisError as e:
+            logger.warning("Info cache delete failed: %s", e)
+
+def get_ydl_opts(file_format):
+    opts = {
+        'format': 'bestaudio/best' if file_format == "mp3" else MP4_FORMAT,
+        'quiet': True,
+        'noplaylist': True,
+        # Keep mtime at download time; the sweeper in app.py expires files by mtime
+        'updatetime': False,
+        # A short socket timeout with yt-dlp's own retries fails a dead host in
+        # seconds; run_conversion only retries on top of this for rate limiting
+        'socket_timeout': 10,
+        'retries': 5,
+        'fragment_retries': 10,
+        'file_access_retries': 3,
+        'referer': 'https://www.youtube.com/',
+        'proxy': get_random_proxy(),
+        'throttled_rate': '500K',
+        'extractor_args': {'youtube': {'skip': ['hls', 'dash'], 'player_client': ['android', 'web']}},
+        'compat_opts': {'youtube-skip-dash-manifest': True, 'no-youtube-unavailable-videos': True},
+        'postprocessor_args': {'ffmpeg': ['-threads', '0']},
+        'ffmpeg_location': FFMPEG_PATH
+    }
+    if IMPERSONATE_TARGET is not None:
+        # curl_cffi sends a real browser's TLS/HTTP2 fingerprint and reuses
+        # connections across fragments; it supplies a matching user agent too
+        opts['impersonate'] = IMPERSONATE_TARGET
+    else:
+        opts['user_agent'] = get_user_agent()
+    if file_format == "mp3":
+        # ExtractAudio already stream-copies when the source is mp3; otherwise
+        # trade a little encoder quality for a faster LAME encode
+        opts['postprocessors'] = [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': '4',  # VBR, same as LAME -V4
+        }]
+        opts['postprocessor_args']['extractaudio'] = ['-compression_level', LAME_COMPRESSION_LEVEL]
+    elif file_format == "mp4":
+        opts['merge_output_format'] = 'mp4'
+    return opts
+
+# Per-process YoutubeDL instances, one per format, reused across batches so the
+# extractor registry and player JS cache are only built once per worker. A pool
+# worker runs one batch at a time, so no locking is needed.
+_WORKER_YDLS = {}
+
+def run_conversion_batch(jobs):
+    """Convert [(url, format), ...] in a worker process; returns one (result, http_status) per job."""
+    return [run_conversion(url, file_format) for url, file_format in jobs]
+
+def run_conversion(url, file_format):
+    global _rate_limited_until
+    for attempt in range(3):
+        from_cache = False
+        try:
+            ydl = _WORKER_YDLS.get(file_format)
+            if ydl is None:
+                ydl = _WORKER_YDLS[file_format] = yt_dlp.YoutubeDL(get_ydl_opts(file_format))
+
+            # Gate on the raw metadata; format selection only runs once, for the download
+            info, from_cache = extract_info_cached(ydl, url)
+            if info.get("_type", "video") != "video":
+                return {"error": "Only single videos are supported"}, 400
+            duration = info.get("duration") or 0
+            if duration > MAX_DURATION_SECONDS:
+                return {"error": "Video too long"}, 400
+
+            title = sanitize_filename(info.get("title", "media"))
+            # Leave the extension to yt-dlp: a fixed "name.mp3" would come out of
+            # ExtractAudio as "name.mp3.mp3" when the source is webm or m4a
+            ydl.params['outtmpl']['default'] = os.path.join(DOWNLOAD_FOLDER, get_output_name(info) + ".%(ext)s")
+
+            # Download from the info we already have instead of resolving the URL again
+            result = ydl.process_ie_result(info, download=True)
+            # Path after merging/postprocessing, i.e. the file actually left on disk
+            output_filename = os.path.basename(result['requested_downloads'][0]['filepath'])
+
+            return {"title": title, "duration": duration, "filename": output_filename}, 200
+
+        except Exception as e:
+            # Any retry gets a fresh instance (new UA/proxy)
+            ydl = _WORKER_YDLS.pop(file_format, None)
+            if ydl:
+                ydl.close()
+            if from_cache:
+                # Cached format URLs may have expired; extract afresh
+                forget_info(url)
+                if attempt < 2:
+                    continue
+            if isinstance(e, yt_dlp.utils.DownloadError):
+                if "bot" in str(e).lower() or "429" in str(e):
+                    _rate_limited_until = time.monotonic() + RATE_LIMIT_COOLDOWN_SECONDS
+                    if attempt < 2:
+                        time.sleep(5 * (attempt + 1))
+                        continue
+                    return {"error": "YouTube temporary restriction", "code": "rate_limit"}, 429
+                return {"error": "Download failed", "details": str(e)}, 400
+            return {"error": "Internal error", "details": str(e)}, 500
+